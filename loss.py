@@ -1,4 +1,6 @@
 import numbers
+
+import numpy as np
 import tensorflow as tf
 
 
@@ -20,7 +22,7 @@ def all_diffs(a, b):
     return tf.expand_dims(a, axis=1) - tf.expand_dims(b, axis=0)
 
 
-def cdist(a, b, metric='euclidean'):
+def cdist(a, b, metric='euclidean', use_matmul=True):
     """Similar to scipy.spatial's cdist, but symbolic.
 
     The currently supported metrics can be listed as `cdist.supported_metrics` and are:
@@ -32,6 +34,9 @@ def cdist(a, b, metric='euclidean'):
         a (2D tensor): The left-hand side, shaped (B1, F).
         b (2D tensor): The right-hand side, shaped (B2, F).
         metric (string): Which distance metric to use, see notes.
+        use_matmul (bool): Whether the (squared) Euclidean distances are
+            computed through a matrix product, see notes, or through all
+            pairwise differences.
 
     Returns:
         The matrix of all pairwise distances between all vectors in `a` and in
@@ -41,15 +46,30 @@ def cdist(a, b, metric='euclidean'):
         When a square root is taken (such as in the Euclidean case), a small
         epsilon is added because the gradient of the square-root at zero is
         undefined. Thus, it will never return exact zero in these cases.
+
+        The (squared) Euclidean distances are computed as |a|² + |b|² - 2ab',
+        which needs a single matrix product instead of all differences. The
+        result is clipped at zero to absorb the rounding errors of this form.
+        These errors grow with the norms of the vectors though, and a lot
+        when the product runs in float16, in which case `use_matmul` should
+        be turned off.
     """
     with tf.compat.v1.name_scope("cdist"):
-        diffs = all_diffs(a, b)
-        if metric == 'sqeuclidean':
-            return tf.reduce_sum(input_tensor=tf.square(diffs), axis=-1)
-        elif metric == 'euclidean':
-            return tf.sqrt(tf.reduce_sum(input_tensor=tf.square(diffs), axis=-1) + 1e-12)
+        if metric in ('sqeuclidean', 'euclidean') and not use_matmul:
+            sq_dists = tf.reduce_sum(input_tensor=tf.square(all_diffs(a, b)), axis=-1)
+            if metric == 'sqeuclidean':
+                return sq_dists
+            return tf.sqrt(sq_dists + 1e-12)
+        elif metric in ('sqeuclidean', 'euclidean'):
+            sq_a = tf.reduce_sum(input_tensor=tf.square(a), axis=1, keepdims=True)
+            sq_b = tf.reduce_sum(input_tensor=tf.square(b), axis=1, keepdims=True)
+            sq_dists = tf.maximum(
+                sq_a + tf.transpose(a=sq_b) - 2.0 * tf.matmul(a, b, transpose_b=True), 0.0)
+            if metric == 'sqeuclidean':
+                return sq_dists
+            return tf.sqrt(sq_dists + 1e-12)
         elif metric == 'cityblock':
-            return tf.reduce_sum(input_tensor=tf.abs(diffs), axis=-1)
+            return tf.reduce_sum(input_tensor=tf.abs(all_diffs(a, b)), axis=-1)
         else:
             raise NotImplementedError(
                 'The following metric is not implemented by `cdist` yet: {}'.format(metric))
@@ -66,7 +86,8 @@ def get_at_indices(tensor, indices):
     return tf.gather_nd(tensor, tf.stack((counter, indices), -1))
 
 
-def batch_hard(dists, pids, margin, batch_precision_at_k=None):
+def batch_hard(dists, pids, margin, batch_precision_at_k=None,
+               batch_p=None, batch_k=None):
     """Computes the batch-hard loss from arxiv.org/abs/1703.07737.
 
     Args:
@@ -76,22 +97,60 @@ def batch_hard(dists, pids, margin, batch_precision_at_k=None):
         margin: The value of the margin if a number, alternatively the string
             'soft' for using the soft-margin formulation, or `None` for not
             using a margin at all.
+        batch_p, batch_k (int): When both are given, the batch is assumed to
+            consist of P consecutive blocks of K entries of the same identity,
+            as produced by PK-sampling. The hardest positives and negatives
+            are then found by reductions over these blocks. The layout is
+            asserted on `pids`, which also are still used for monitoring.
 
     Returns:
         A 1D tensor of shape (B,) containing the loss value for each sample.
     """
+    pk_layout = batch_p is not None and batch_k is not None
+
     with tf.compat.v1.name_scope("batch_hard"):
         same_identity_mask = tf.equal(tf.expand_dims(pids, axis=1),
                                       tf.expand_dims(pids, axis=0))
         negative_mask = tf.logical_not(same_identity_mask)
         positive_mask = tf.math.logical_xor(same_identity_mask,
-                                       tf.eye(tf.shape(input=pids)[0], dtype=tf.bool))
-
-        furthest_positive = tf.reduce_max(input_tensor=dists*tf.cast(positive_mask, tf.float32), axis=1)
-        closest_negative = tf.map_fn(lambda x: tf.reduce_min(input_tensor=tf.boolean_mask(tensor=x[0], mask=x[1])),
-                                    (dists, negative_mask), tf.float32)
-        # Another way of achieving the same, though more hacky:
-        # closest_negative = tf.reduce_min(dists + 1e5*tf.cast(same_identity_mask, tf.float32), axis=1)
+                                       tf.eye(tf.shape(input=dists)[0], dtype=tf.bool))
+
+        if pk_layout:
+            # Check on the PIDs that the batch really is laid out as P blocks
+            # of K entries of one identity each, with P different identities,
+            # as wrong labels would be trained on silently otherwise.
+            pid_blocks = tf.reshape(pids, (batch_p, batch_k))
+            layout_checks = [
+                tf.debugging.assert_equal(
+                    pid_blocks, tf.tile(pid_blocks[:, :1], (1, batch_k)),
+                    message='The K entries of a block have different PIDs.'),
+                tf.debugging.assert_equal(
+                    tf.size(input=tf.unique(pid_blocks[:, 0])[0]), batch_p,
+                    message='Several blocks of the batch have the same PID.'),
+            ]
+            with tf.control_dependencies(layout_checks):
+                blocks = tf.reshape(dists, (batch_p, batch_k, batch_p, batch_k))
+
+            # The positives are the diagonal KxK blocks, shaped (K, K, P) here.
+            # The distance to self is included, but it never is the largest.
+            positive_blocks = tf.linalg.diag_part(tf.transpose(a=blocks, perm=(1, 3, 0, 2)))
+            furthest_positive = tf.reshape(tf.transpose(
+                a=tf.reduce_max(input_tensor=positive_blocks, axis=1)), (-1,))
+
+            # The negatives are all other blocks, so reduce over each block
+            # and then ignore the diagonal ones, shaped (K, P, P) here.
+            closest_per_block = tf.transpose(
+                a=tf.reduce_min(input_tensor=blocks, axis=3), perm=(1, 0, 2))
+            closest_per_block = tf.linalg.set_diag(
+                closest_per_block, tf.fill((batch_k, batch_p), np.inf))
+            closest_negative = tf.reshape(tf.transpose(
+                a=tf.reduce_min(input_tensor=closest_per_block, axis=2)), (-1,))
+        else:
+            furthest_positive = tf.reduce_max(input_tensor=dists*tf.cast(positive_mask, tf.float32), axis=1)
+            closest_negative = tf.map_fn(lambda x: tf.reduce_min(input_tensor=tf.boolean_mask(tensor=x[0], mask=x[1])),
+                                        (dists, negative_mask), tf.float32)
+            # Another way of achieving the same, though more hacky:
+            # closest_negative = tf.reduce_min(dists + 1e5*tf.cast(same_identity_mask, tf.float32), axis=1)
 
         diff = furthest_positive - closest_negative
         if isinstance(margin, numbers.Real):
@@ -0,0 +1,68 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import train
+
+
+def slow_read(latency):
+    """ Returns a `read_fn` for `read_pk_batches` which only waits a while. """
+    def wait(seconds):
+        time.sleep(float(seconds))
+        return np.float32(seconds)
+
+    def read_fn(indices, pids):
+        seconds = tf.numpy_function(wait, [latency()], tf.float32)
+        with tf.control_dependencies([seconds]):
+            return tf.identity(indices), tf.identity(pids)
+    return read_fn
+
+
+def consume(dataset, count, warmup):
+    """ Returns `count` elements of `dataset`, after skipping `warmup` ones to
+    start the pipeline, and how long they took.
+    """
+    # Reading is latency bound, so don't depend on the machine's cores here.
+    options = tf.data.Options()
+    options.threading.private_threadpool_size = 16
+    dataset = dataset.with_options(options)
+
+    next_element = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+    with tf.compat.v1.Session() as sess:
+        for _ in range(warmup):
+            sess.run(next_element)
+        start_time = time.time()
+        elements = [sess.run(next_element) for _ in range(count)]
+        return elements, time.time() - start_time
+
+
+def test_reads_overlap():
+    batch_p, batch_k, groups, latency = 4, 2, 64, 0.02
+    indices = np.arange(groups * batch_k, dtype=np.int32).reshape(groups, batch_k)
+    pids = np.repeat(np.arange(groups), batch_k).reshape(groups, batch_k).astype(str)
+    dataset = tf.data.Dataset.from_tensor_slices((indices, pids)).repeat(None)
+    dataset = train.read_pk_batches(
+        dataset, slow_read(lambda: tf.constant(latency)), batch_p, cycle_length=4)
+
+    _, elapsed = consume(dataset, groups, warmup=batch_p)
+    assert elapsed < groups * latency / 4
+
+
+def test_batches_keep_their_pids():
+    batch_p, batch_k = 8, 2
+    pids = np.repeat(np.arange(40), 3).astype(str)
+    sample_pk = train.make_pk_sampler(pids, batch_p, batch_k)
+    dataset = tf.data.Dataset.from_generator(sample_pk, output_signature=(
+        tf.TensorSpec(shape=(batch_k,), dtype=tf.int32),
+        tf.TensorSpec(shape=(batch_k,), dtype=tf.string)))
+    dataset = train.read_pk_batches(
+        dataset, slow_read(lambda: tf.random.uniform((), maxval=0.01)),
+        batch_p, cycle_length=4)
+
+    groups, _ = consume(dataset, 100 * batch_p, warmup=batch_p)
+    for b in range(100):
+        batch = groups[b * batch_p:(b + 1) * batch_p]
+        for _, group_pids in batch:
+            assert len(set(group_pids)) == 1
+        assert len({group_pids[0] for _, group_pids in batch}) == batch_p
@@ -2,13 +2,16 @@
 import json
 import logging.config
 import os
+import queue
 import sys
+import threading
 import time
 from argparse import ArgumentParser
 from datetime import timedelta
 from importlib import import_module
 from signal import SIGINT, SIGTERM
 
+import h5py
 import numpy as np
 import tensorflow as tf
 import tensorflow_addons as tfa
@@ -21,6 +24,9 @@ from nets import NET_CHOICES
 
 # os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
+# The nets are tf_slim models, which rely on the graph collections (variables,
+# batchnorm update ops, summaries) and thus on graph mode. The training step is
+# still built only once, see `make_step_callables` below.
 tf.compat.v1.disable_eager_execution()
 
 parser = ArgumentParser(description='Train a ReID network.')
@@ -97,7 +103,7 @@ parser.add_argument(
 
 parser.add_argument(
     '--loading_threads', default=8, type=common.positive_int,
-    help='Number of threads used for parallel loading.')
+    help='Number of PK batches whose image files are read in parallel.')
 
 parser.add_argument(
     '--margin', default='soft', type=common.float_or_string,
@@ -131,6 +137,17 @@ parser.add_argument(
          'disable intermediate storing. This will result in only one final '
          'checkpoint.')
 
+parser.add_argument(
+    '--summary_frequency', default=50, type=common.positive_int,
+    help='After how many iterations the TensorBoard summaries are stored. The '
+         'iteration speed is still stored for every single iteration.')
+
+parser.add_argument(
+    '--val_frequency', default=50, type=common.positive_int,
+    help='After how many iterations a batch of the `test_set` is evaluated and'
+         ' its summaries are stored. The detailed logs of all other iterations'
+         ' stay empty for validation.')
+
 parser.add_argument(
     '--flip_augment', action='store_true', default=False,
     help='When this flag is provided, flip augmentation is performed.')
@@ -148,28 +165,328 @@ parser.add_argument(
 parser.add_argument(
     '--detailed_logs', action='store_true', default=False,
     help='Store very detailed logs of the training in addition to TensorBoard'
-         ' summaries. These are mem-mapped numpy files containing the'
-         ' embeddings, losses and FIDs seen in each batch during training.'
-         ' Everything can be re-constructed and analyzed that way.')
+         ' summaries. These are datasets in the compressed `detailed_logs.h5`'
+         ' file containing the embeddings, losses and FIDs seen in each batch'
+         ' during training. Everything can be re-constructed and analyzed that'
+         ' way.')
+
+parser.add_argument(
+    '--cache_decoded', choices=['memory', 'disk'], default=None,
+    help='Decode all images only once and keep them in memory for the whole'
+         ' training, instead of loading them anew for every batch. `disk`'
+         ' additionally stores the decoded images in the experiment_root, such'
+         ' that resuming doesn\'t need to decode them again. Make sure the'
+         ' dataset fits in memory when using this.')
+
+parser.add_argument(
+    '--mixed_precision', action='store_true', default=False,
+    help='When this flag is provided, the graph is rewritten to compute in'
+         ' float16 where TensorFlow considers it safe, using dynamic loss'
+         ' scaling. Input batches are then also staged as float16. This only'
+         ' pays off on GPUs with TensorCores. It does trade some precision for'
+         ' speed: the network and the embeddings are computed in float16. The'
+         ' pairwise distances are then computed from all differences of the'
+         ' embeddings, which is slower than a matrix product but keeps them'
+         ' from losing most of their precision.')
+
+parser.add_argument(
+    '--xla', action='store_true', default=False,
+    help='When this flag is provided, the graph is JIT-compiled with XLA, which'
+         ' fuses the network and loss computations into fewer kernels. The'
+         ' first iterations are slower due to the compilation.')
+
+
+def make_pk_sampler(pids, batch_p, batch_k, name='train'):
+    """ Groups the FID indices by PID and returns a generator sampling them.
 
+    The generator yields the indices of K FIDs of a PID together with K copies
+    of that PID, looping over the PIDs forever. One "epoch" loops over all
+    PIDs, which are shuffled after every epoch.
 
-def sample_k_fids_for_pid(pid, all_fids, all_pids, batch_k):
-    """ Given a PID, select K FIDs of that specific PID. """
-    possible_fids = tf.boolean_mask(tensor=all_fids, mask=tf.equal(all_pids, pid))
+    Raises:
+        ValueError if the `name`d set has fewer than `batch_p` PIDs, as not a
+        single batch could be sampled from it.
+    """
+    unique_pids, offsets, indices = common.group_by_pid(pids)
 
-    # The following simply uses a subset of K of the possible FIDs
-    # if more than, or exactly K are available. Otherwise, we first
-    # create a padded list of indices which contain a multiple of the
-    # original FID count such that all of them will be sampled equally likely.
-    count = tf.shape(input=possible_fids)[0]
-    padded_count = tf.cast(tf.math.ceil(batch_k / tf.cast(count, tf.float32)), tf.int32) * count
-    full_range = tf.math.mod(tf.range(padded_count), count)
+    # Constrain the epoch size to a multiple of the batch-size, so that
+    # we don't get overlap at the end of each epoch.
+    epoch_size = (len(unique_pids) // batch_p) * batch_p
+    if epoch_size == 0:
+        raise ValueError('The {} set only has {} PIDs, which is less than the '
+                         'batch_p of {}.'.format(name, len(unique_pids), batch_p))
+
+    def sample_pk():
+        while True:
+            for row in np.random.permutation(len(unique_pids))[:epoch_size]:
+                possible_indices = indices[offsets[row]:offsets[row + 1]]
+
+                # The following simply uses a subset of K of the possible FIDs
+                # if more than, or exactly K are available. Otherwise, we first
+                # create a padded list of indices which contain a multiple of the
+                # original FID count such that all of them will be sampled equally likely.
+                # Note that no padding happens at all in the former case.
+                count = len(possible_indices)
+                padded_count = -(-batch_k // count) * count
+                selected = np.random.choice(padded_count, batch_k, replace=False)
+
+                yield (possible_indices[selected % count],
+                       np.full(batch_k, unique_pids[row]))
+
+    return sample_pk
+
+
+def decode_all_images(fids, image_root, image_size, cache_file=None):
+    """ Loads all images given by `fids` into a single uint8 tensor.
+
+    If `cache_file` is given, the decoded images are also stored there and read
+    back from there by later runs. Otherwise, every new run decodes them again.
+    """
+    # Round rather than truncate the resized images, such that they match the
+    # ones loaded without the cache, as well as those of embed.py.
+    dataset = tf.data.Dataset.from_tensor_slices(fids)
+    dataset = dataset.map(
+        lambda fid: tf.saturate_cast(tf.round(common.decode_image(
+            common.read_image(fid, image_root), image_size)), tf.uint8),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if cache_file is not None:
+        dataset = dataset.cache(cache_file)
+    return tf.data.experimental.get_single_element(dataset.batch(fids.shape[0]))
+
+
+def read_images(indices, pids, all_fids, image_root):
+    """ Reads the files of the FIDs at `indices` in `all_fids`, still encoded.
+
+    Returns the encoded images, the FIDs and passes-through the PIDs.
+    """
+    fids = tf.gather(all_fids, indices)
+    images_encoded = tf.map_fn(
+        lambda fid: common.read_image(fid, image_root), fids,
+        fn_output_signature=tf.string, parallel_iterations=pids.shape[0])
+    return images_encoded, fids, pids
+
+
+def read_pk_batches(dataset, read_fn, batch_p, cycle_length):
+    """ Applies `read_fn` to the K-groups of `dataset`, many of them concurrently.
+
+    The reads of the P K-groups of one batch run in parallel and may finish
+    out of order, and `cycle_length` batches are read at the same time. Groups
+    are never reordered across batches though, so every batch still holds the
+    same P different PIDs as sampled, even across epoch boundaries.
+    """
+    dataset = dataset.batch(batch_p, drop_remainder=True)
+    return dataset.interleave(
+        lambda *batch: tf.data.Dataset.from_tensor_slices(batch).map(
+            read_fn, num_parallel_calls=batch_p, deterministic=False),
+        cycle_length=cycle_length, block_length=batch_p,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=True)
+
+
+def decode_image(image_encoded, fid, pid, image_size, dtype=tf.float32):
+    """ Decodes an image read by `read_images` as `dtype`. Pass-through the FID and PID. """
+    return tf.cast(common.decode_image(image_encoded, image_size), dtype), fid, pid
+
+
+def load_cached_image(index, pid, all_fids, cached_images, dtype=tf.float32):
+    """ Loads the image of the FID at `index` in `all_fids` as `dtype` from
+    `cached_images` as returned by `decode_all_images`. Pass-through the PID.
+    """
+    image = tf.cast(tf.gather(cached_images, index), dtype)
+    return image, tf.gather(all_fids, index), pid
+
+
+def augment_batch(images, fids, pids, net_input_size,
+                  flip=False, rotate=False, crop=False):
+    """ Applies the requested augmentations to a whole batch at once.
+
+    Each image still gets its own random flip, rotation angle and crop.
+    """
+    batch_size = tf.shape(input=images)[0]
+
+    if flip:
+        images = tf.image.random_flip_left_right(images)
+    if rotate:
+        angles = tf.random.uniform(shape=(batch_size,), minval=-np.pi / 4, maxval=np.pi / 4)
+        images = tfa.image.rotate(images, angles)
+    if crop:
+        # A box of exactly the crop size, aligned to the pixel grid, makes
+        # `crop_and_resize` a plain crop, but with a different offset per image.
+        image_size = tf.cast(tf.shape(input=images)[1:3], tf.float32)
+        crop_size = tf.constant(net_input_size, dtype=tf.float32)
+        offsets = tf.floor(tf.random.uniform(shape=(batch_size, 2)) * (image_size - crop_size + 1))
+        boxes = tf.concat([offsets, offsets + crop_size - 1], axis=1) / tf.tile(image_size - 1, [2])
+        images = tf.image.crop_and_resize(
+            images, boxes, box_indices=tf.range(batch_size), crop_size=net_input_size)
+
+    return images, fids, pids
+
+
+def decoded_cache_file(args, name, image_size):
+    """ Returns where to cache decoded images as per `args.cache_decoded`. """
+    if args.cache_decoded != 'disk':
+        return None
+    return os.path.join(args.experiment_root, 'decoded_{}_{}x{}'.format(
+        name, *image_size))
+
+
+def create_or_resize_log(log_file, name, dtype, shape, chunk_iterations=64):
+    """ Returns the dataset `name` of the h5 `log_file`, holding `shape[0]` iterations.
+
+    The dataset is created if it doesn't exist yet, or grown to that many
+    iterations otherwise, e.g. when resuming with more `train_iterations`.
+    It is stored lzf-compressed in chunks of `chunk_iterations` iterations.
+    """
+    if name in log_file:
+        log_file[name].resize(shape[0], axis=0)
+        return log_file[name]
+
+    return log_file.create_dataset(
+        name, shape=shape, dtype=dtype, maxshape=(None,) + shape[1:],
+        chunks=(chunk_iterations,) + shape[1:],
+        compression='lzf')
+
+
+def write_detailed_logs(log_queue, log_arrays, log_errors, buffer_iterations=64):
+    """ Stores the entries of `log_queue` in the detailed `log_arrays`.
+
+    Each entry is a tuple of the iteration followed by the values to store in
+    the first few of `log_arrays`. Runs until a `None` entry is received.
+    The entries are buffered and written `buffer_iterations` at once, such that
+    the compressed chunks are mostly written as a whole instead of row by row.
+
+    If writing fails, the exception is appended to `log_errors` for the
+    training loop to re-raise, and all further entries are discarded such
+    that putting them never blocks.
+    """
+    buffers = [([], []) for _ in log_arrays]
+
+    def flush():
+        for array, (iterations, values) in zip(log_arrays, buffers):
+            if iterations:
+                array[iterations] = np.asarray(values, dtype=array.dtype)
+                del iterations[:], values[:]
+
+    try:
+        for n, entry in enumerate(iter(log_queue.get, None), 1):
+            i, values = entry[0], entry[1:]
+            for (iterations, buffered), value in zip(buffers, values):
+                iterations.append(i)
+                buffered.append(value)
+            if n % buffer_iterations == 0:
+                flush()
+        flush()
+    except Exception as e:
+        log_errors.append(e)
+        for _ in iter(log_queue.get, None):
+            pass
+
+
+def make_step_callables(sess, fetches, train_op, global_step, is_validation=None):
+    """ Precompiles the training and validation steps for `fetches`.
+
+    `fetches` maps the names of the optional fetches to their tensors, all of
+    which are only fetched when requested. Returns a function which, given the
+    requested names, returns a callable performing one training step and one
+    performing one validation step (or None without validation). As validation
+    only runs every so often, its step always fetches the 'summary' too. Such
+    callables are built by the session only once per set of names, so that the
+    fetches and feeds don't need to be processed again in every iteration.
+    """
+    callables = {}
+
+    def get(*names):
+        if names not in callables:
+            step_fetches = {name: fetches[name] for name in names}
+            train_step = sess.make_callable([train_op, global_step, step_fetches])
+            val_step = None
+            if is_validation is not None:
+                val_step = sess.make_callable(
+                    dict(step_fetches, summary=fetches['summary']), feed_list=[is_validation])
+            callables[names] = (train_step, val_step)
+        return callables[names]
+
+    return get
+
+
+def make_pk_dataset(args, pids, fids, name, image_size, dtype=tf.float32):
+    """ Builds the endless input pipeline of PK batches for a dataset.
+
+    The images are loaded in `image_size` and as `dtype`, augmentation is left
+    to the model side. `name` is used for the files of the decoded images cache.
+    """
+    # Group the FIDs by PID once, such that sampling doesn't need to scan all
+    # FIDs for every single PID it draws. The pipeline passes around indices
+    # into `fids_const`, which is materialized only once for all of it.
+    sample_pk = make_pk_sampler(pids, args.batch_p, args.batch_k, name)
+    fids_const = tf.constant(fids)
+
+    # Possibly decode all images once upfront.
+    cached_images = None
+    if args.cache_decoded:
+        cached_images = decode_all_images(
+            fids_const, args.image_root, image_size, cache_file=decoded_cache_file(
+                args, name, image_size))
+
+    # Setup a tf.Dataset which endlessly yields K images for every PID. The
+    # sampling itself is cheap and done in numpy, see `make_pk_sampler`.
+    dataset = tf.data.Dataset.from_generator(sample_pk, output_signature=(
+        tf.TensorSpec(shape=(args.batch_k,), dtype=tf.int32),
+        tf.TensorSpec(shape=(args.batch_k,), dtype=tf.string)))
+
+    if cached_images is None:
+        # Read the files of many PIDs concurrently, such that slow storage
+        # doesn't stall the pipeline. The K images of a PID are always read
+        # together, so letting the reads finish out of order still keeps them
+        # next to each other, as required for the PK-batches.
+        dataset = read_pk_batches(
+            dataset, lambda indices, pids: read_images(
+                indices, pids, all_fids=fids_const, image_root=args.image_root),
+            batch_p=args.batch_p, cycle_length=args.loading_threads)
+
+        def load_fn(image_encoded, fid, pid):
+            return decode_image(
+                image_encoded, fid, pid, image_size=image_size, dtype=dtype)
+    else:
+        def load_fn(index, pid):
+            return load_cached_image(
+                index, pid, all_fids=fids_const, cached_images=cached_images,
+                dtype=dtype)
+
+    # Ungroup/flatten the batches for easy loading of the files.
+    dataset = dataset.unbatch()
 
-    # Sampling is always performed by shuffling and taking the first k.
-    shuffled = tf.random.shuffle(full_range)
-    selected_fids = tf.gather(possible_fids, shuffled[:batch_k])
+    # Convert the files to actual image tensors and group them back into PK
+    # batches, all in one go.
+    dataset = dataset.apply(tf.data.experimental.map_and_batch(
+        map_func=load_fn,
+        batch_size=args.batch_p * args.batch_k,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        drop_remainder=True))
 
-    return selected_fids, tf.fill([batch_k], pid)
+    # Overlap producing and consuming for parallelism.
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    dataset = dataset.with_options(input_pipeline_options())
+
+    # Stage the next batches on the GPU while the current one is being
+    # processed. This needs to be the very last transformation.
+    if tf.config.list_physical_devices('GPU'):
+        dataset = dataset.apply(tf.data.experimental.prefetch_to_device('/gpu:0', buffer_size=2))
+
+    return dataset
+
+
+def input_pipeline_options():
+    """ Returns the `tf.data.Options` used for the PK input pipelines. """
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.parallel_batch = True
+    # Note that we keep the deterministic default: the PK-batches rely on
+    # the K images of each PID arriving next to each other, which would no
+    # longer be guaranteed if parallel maps were allowed to reorder them.
+    # Only the reading of the K-groups within a batch, see `read_pk_batches`,
+    # opts out.
+    return options
 
 
 def main():
@@ -238,104 +555,63 @@ def main():
         log.error("You did not specify the required `image_root` argument!")
         sys.exit(1)
 
+    # The loss-scaling optimizer only applies its update under a `tf.cond`,
+    # which fails to create the optimizer's slots with v2 control flow.
+    if args.mixed_precision:
+        tf.compat.v1.disable_control_flow_v2()
+
     # Load the data from the CSV file.
     pids, fids = common.load_dataset(args.train_set, args.image_root)
     max_fid_len = max(map(len, fids))  # We'll need this later for logfiles.
 
-    # Setup a tf.Dataset where one "epoch" loops over all PIDS.
-    # PIDS are shuffled after every epoch and continue indefinitely.
-    unique_pids = np.unique(pids)
-    dataset = tf.data.Dataset.from_tensor_slices(unique_pids)
-    dataset = dataset.shuffle(len(unique_pids))
-
-    # Constrain the dataset size to a multiple of the batch-size, so that
-    # we don't get overlap at the end of each epoch.
-    dataset = dataset.take((len(unique_pids) // args.batch_p) * args.batch_p)
-    dataset = dataset.repeat(None)  # Repeat forever. Funny way of stating it.
-
-    # For every PID, get K images.
-    dataset = dataset.map(lambda pid: sample_k_fids_for_pid(
-        pid, all_fids=fids, all_pids=pids, batch_k=args.batch_k))
-
-    # Ungroup/flatten the batches for easy loading of the files.
-    dataset = dataset.unbatch()
-
-    # Convert filenames to actual image tensors.
+    # Setup the input pipelines. Augmentation happens on the whole batch later,
+    # so cropping needs the images loaded in the larger pre-crop size.
+    # With mixed precision, batches are staged as float16, halving their size.
     net_input_size = (args.net_input_height, args.net_input_width)
     pre_crop_size = (args.pre_crop_height, args.pre_crop_width)
-    dataset = dataset.map(
-        lambda fid, pid: common.fid_to_image(
-            fid, pid, image_root=args.image_root,
-            image_size=pre_crop_size if args.crop_augment else net_input_size),
-        num_parallel_calls=args.loading_threads)
-
-    # Augment the data if specified by the arguments.
-    if args.flip_augment:
-        random_angles = tf.random.uniform(shape=(), minval=0, maxval=1, dtype=tf.int32) * 2
-        dataset = dataset.map(
-            lambda im, fid, pid: (tf.image.rot90(im, k=random_angles), fid, pid))
-    if args.rotate_augment:
-        random_angles = tf.random.uniform(shape=(), minval=-np.pi / 4, maxval=np.pi / 4)
-        dataset = dataset.map(
-            lambda im, fid, pid: (tfa.image.rotate(im, random_angles), fid, pid))
-    if args.crop_augment:
-        dataset = dataset.map(
-            lambda im, fid, pid: (tf.image.random_crop(im, net_input_size + (3,)), fid, pid))
-
-    # Group it back into PK batches.
-    batch_size = args.batch_p * args.batch_k
-    dataset = dataset.batch(batch_size)
-
-    # Overlap producing and consuming for parallelism.
-    dataset = dataset.prefetch(1)
+    load_size = pre_crop_size if args.crop_augment else net_input_size
+    input_dtype = tf.float16 if args.mixed_precision else tf.float32
+    dataset = make_pk_dataset(args, pids, fids, 'train', load_size, input_dtype)
 
-    # Since we repeat the data infinitely, we only need a one-shot iterator.
+    # Since we repeat the data infinitely, we only need to initialize once.
+    # Validation keeps an iterator of its own, such that its batches are only
+    # produced when they are used. Both pipelines run in the same thread pool.
     dataset_iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
-    images, fids, pids = dataset_iterator.get_next()
-    images_ph = tf.compat.v1.placeholder(images.dtype, shape=images.get_shape())
-    pids_ph = tf.compat.v1.placeholder(pids.dtype, shape=pids.get_shape())
 
-    test_images = None
+    test_iterator = None
+    # Validation isn't augmented, so it is always loaded in the network's input
+    # size, such that it is evaluated at the same resolution as training.
     if args.test_set:
-        # Load the data from the CSV file.
         test_pids, test_fids = common.load_dataset(args.test_set, args.image_root)
-
-        # Setup a tf.Dataset where one "epoch" loops over all PIDS.
-        # PIDS are shuffled after every epoch and continue indefinitely.
-        test_unique_pids = np.unique(test_pids)
-        test_dataset = tf.data.Dataset.from_tensor_slices(test_unique_pids)
-        test_dataset = test_dataset.shuffle(len(test_unique_pids))
-
-        # Constrain the dataset size to a multiple of the batch-size, so that
-        # we don't get overlap at the end of each epoch.
-        test_dataset = test_dataset.take((len(test_unique_pids) // args.batch_p) * args.batch_p)
-        test_dataset = test_dataset.repeat(None)  # Repeat forever. Funny way of stating it.
-
-        # For every PID, get K images.
-        test_dataset = test_dataset.map(lambda pid: sample_k_fids_for_pid(
-            pid, all_fids=test_fids, all_pids=test_pids, batch_k=args.batch_k))
-
-        # Ungroup/flatten the batches for easy loading of the files.
-        test_dataset = test_dataset.unbatch()
-
-        # Convert filenames to actual image tensors.
-        net_input_size = (args.net_input_height, args.net_input_width)
-        pre_crop_size = (args.pre_crop_height, args.pre_crop_width)
-        test_dataset = test_dataset.map(
-            lambda fid, pid: common.fid_to_image(
-                fid, pid, image_root=args.image_root,
-                image_size=pre_crop_size if args.crop_augment else net_input_size),
-            num_parallel_calls=args.loading_threads)
-
-        # Group it back into PK batches.
-        test_batch_size = args.batch_p * args.batch_k
-        test_dataset = test_dataset.batch(test_batch_size)
-
-        # Overlap producing and consuming for parallelism.
-        test_dataset = test_dataset.prefetch(1)
-
-        # Since we repeat the data infinitely, we only need a one-shot iterator.
-        test_images, test_fids, test_pids = tf.compat.v1.data.make_one_shot_iterator(test_dataset).get_next()
+        test_dataset = make_pk_dataset(
+            args, test_pids, test_fids, 'validation', net_input_size, input_dtype)
+        test_iterator = tf.compat.v1.data.make_initializable_iterator(test_dataset)
+
+    # Augment the training batches if specified by the arguments. This is done
+    # on the whole batch at once, on the same device as the model. Also turn
+    # possibly float16-staged batches back to float32, the graph rewrite of
+    # mixed precision decides on its own where to compute in float16.
+    def next_train_batch():
+        images, fids, pids = dataset_iterator.get_next()
+        return augment_batch(
+            tf.cast(images, tf.float32), fids, pids, net_input_size=net_input_size,
+            flip=args.flip_augment, rotate=args.rotate_augment, crop=args.crop_augment)
+
+    def next_test_batch():
+        images, fids, pids = test_iterator.get_next()
+        return tf.cast(images, tf.float32), fids, pids
+
+    # The model is fed directly from the iterators, so batches never make a
+    # round-trip through the host. Feeding `is_validation` switches the input
+    # over to the validation batches.
+    is_validation = None
+    if test_iterator is not None:
+        is_validation = tf.compat.v1.placeholder_with_default(False, shape=())
+        images, fids, pids = tf.cond(
+            pred=is_validation, true_fn=next_test_batch,
+            false_fn=next_train_batch)
+    else:
+        images, fids, pids = next_train_batch()
 
     # Create the model and an embedding head.
     model = import_module('nets.' + args.model_name)
@@ -344,20 +620,26 @@ def main():
     # Feed the image through the model. The returned `body_prefix` will be used
     # further down to load the pre-trained weights for all variables with this
     # prefix.
-    endpoints, body_prefix = model.endpoints(images_ph, is_training=True)
+    endpoints, body_prefix = model.endpoints(images, is_training=True)
     with tf.compat.v1.name_scope('head'):
         endpoints = head.head(endpoints, args.embedding_dim, is_training=True)
 
     # Create the loss in two steps:
     # 1. Compute all pairwise distances according to the specified metric.
     # 2. For each anchor along the first dimension, compute its loss.
-    dists = loss.cdist(endpoints['emb'], endpoints['emb'], metric=args.metric)
+    # With mixed precision, the matrix product `cdist` uses by default would
+    # be computed in float16, losing too much precision in the distances.
+    dists = loss.cdist(endpoints['emb'], endpoints['emb'], metric=args.metric,
+                       use_matmul=not args.mixed_precision)
     losses, train_top1, prec_at_k, _, neg_dists, pos_dists = loss.LOSS_CHOICES[args.loss](
-        dists, pids_ph, args.margin, batch_precision_at_k=args.batch_k - 1)
+        dists, pids, args.margin, batch_precision_at_k=args.batch_k - 1,
+        batch_p=args.batch_p, batch_k=args.batch_k)
 
     # Count the number of active entries, and compute the total batch loss.
     num_active = tf.reduce_sum(input_tensor=tf.cast(tf.greater(losses, 1e-5), tf.float32))
     loss_mean = tf.reduce_mean(input_tensor=losses)
+    loss_min = tf.reduce_min(input_tensor=losses)
+    loss_max = tf.reduce_max(input_tensor=losses)
 
     # Some logging for tensorboard.
     tf.compat.v1.summary.histogram('loss_distribution', losses)
@@ -371,28 +653,30 @@ def main():
     tf.compat.v1.summary.histogram('embedding_lengths',
                                    tf.norm(tensor=endpoints['emb_raw'], axis=1))
 
-    # Create the mem-mapped arrays in which we'll log all training detail in
-    # addition to tensorboard, because tensorboard is annoying for detailed
-    # inspection and actually discards data in histogram summaries.
+    # Create the datasets in which we'll log all training detail in addition
+    # to tensorboard, because tensorboard is annoying for detailed inspection
+    # and actually discards data in histogram summaries.
     if args.detailed_logs:
-        log_embs = lb.create_or_resize_dat(
-            os.path.join(args.experiment_root, 'embeddings'),
+        batch_size = args.batch_p * args.batch_k
+        log_file = h5py.File(os.path.join(args.experiment_root, 'detailed_logs.h5'), 'a')
+        log_embs = create_or_resize_log(
+            log_file, 'embeddings',
             dtype=np.float32, shape=(args.train_iterations, batch_size, args.embedding_dim))
-        log_loss = lb.create_or_resize_dat(
-            os.path.join(args.experiment_root, 'losses'),
+        log_loss = create_or_resize_log(
+            log_file, 'losses',
             dtype=np.float32, shape=(args.train_iterations, batch_size))
-        log_fids = lb.create_or_resize_dat(
-            os.path.join(args.experiment_root, 'fids'),
+        log_fids = create_or_resize_log(
+            log_file, 'fids',
             dtype='S' + str(max_fid_len), shape=(args.train_iterations, batch_size))
-        if test_images:
-            log_val_embs = lb.create_or_resize_dat(
-                os.path.join(args.experiment_root, 'val_embeddings'),
+        if test_iterator is not None:
+            log_val_embs = create_or_resize_log(
+                log_file, 'val_embeddings',
                 dtype=np.float32, shape=(args.train_iterations, batch_size, args.embedding_dim))
-            log_val_loss = lb.create_or_resize_dat(
-                os.path.join(args.experiment_root, 'val_losses'),
+            log_val_loss = create_or_resize_log(
+                log_file, 'val_losses',
                 dtype=np.float32, shape=(args.train_iterations, batch_size))
-            log_val_fids = lb.create_or_resize_dat(
-                os.path.join(args.experiment_root, 'val_fids'),
+            log_val_fids = create_or_resize_log(
+                log_file, 'val_fids',
                 dtype='S' + str(max_fid_len), shape=(args.train_iterations, batch_size))
 
     # These are collected here before we add the optimizer, because depending
@@ -416,6 +700,12 @@ def main():
     # Feel free to try others!
     # optimizer = tf.train.AdadeltaOptimizer(learning_rate)
 
+    # Possibly compute in float16 where it is numerically safe. The loss
+    # scaling keeps small gradients from flushing to zero.
+    if args.mixed_precision:
+        optimizer = tf.compat.v1.mixed_precision.enable_mixed_precision_graph_rewrite(
+            optimizer, loss_scale='dynamic')
+
     # Update_ops are used to update batchnorm stats.
     with tf.control_dependencies(tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.UPDATE_OPS)):
         train_op = optimizer.minimize(loss_mean, global_step=global_step)
@@ -423,7 +713,13 @@ def main():
     # Define a saver for the complete model.
     checkpoint_saver = tf.compat.v1.train.Saver(max_to_keep=0)
 
-    with tf.compat.v1.Session() as sess:
+    # The batch shapes are fixed, so XLA only needs to compile the graph once.
+    config = tf.compat.v1.ConfigProto()
+    if args.xla:
+        config.graph_options.optimizer_options.global_jit_level = (
+            tf.compat.v1.OptimizerOptions.ON_2)
+
+    with tf.compat.v1.Session(config=config) as sess:
         if args.resume:
             # In case we're resuming, simply load the full checkpoint to init.
             last_checkpoint = tf.train.latest_checkpoint(args.experiment_root)
@@ -446,84 +742,135 @@ def main():
         summary_writer = tf.compat.v1.summary.FileWriter(os.path.join(args.experiment_root, 'train'), sess.graph)
         test_summary_writer = tf.compat.v1.summary.FileWriter(os.path.join(args.experiment_root, 'validation'), sess.graph)
         sess.run(dataset_iterator.initializer)
+        if test_iterator is not None:
+            sess.run(test_iterator.initializer)
 
         start_step = sess.run(global_step)
+
+        step_names = ('prec_at_k', 'loss_min', 'loss_mean', 'loss_max')
+        if args.detailed_logs:
+            step_names += ('embs', 'loss', 'fids')
+        get_steps = make_step_callables(sess, {
+            'prec_at_k': prec_at_k, 'loss_min': loss_min,
+            'loss_mean': loss_mean, 'loss_max': loss_max,
+            'summary': merged_summary, 'embs': endpoints['emb'],
+            'loss': losses, 'fids': fids,
+        }, train_op, global_step, is_validation)
         log.info('Starting training from iteration {}.'.format(start_step))
 
+        # Writing the detailed logs is left to a background thread, such that
+        # the training loop doesn't wait for the disk.
+        if args.detailed_logs:
+            log_arrays = [log_embs, log_loss, log_fids]
+            if test_iterator is not None:
+                log_arrays += [log_val_embs, log_val_loss, log_val_fids]
+            log_queue = queue.Queue(maxsize=32)
+            log_errors = []
+            log_writer = threading.Thread(
+                target=write_detailed_logs, args=(log_queue, log_arrays, log_errors),
+                daemon=True)
+            log_writer.start()
+
         # Finally, here comes the main-loop. This `Uninterrupt` is a handy
         # utility such that an iteration still finishes on Ctrl+C and we can
         # stop the training cleanly.
-        with lb.Uninterrupt(sigs=[SIGINT, SIGTERM], verbose=True) as u:
-            for i in range(start_step, args.train_iterations):
-
-                # Compute gradients, update weights, store logs!
-                start_time = time.time()
-                images_val, pids_val = sess.run([images, pids])
-                _, summary, step, b_prec_at_k, b_embs, b_loss, b_fids = \
-                    sess.run([train_op, merged_summary, global_step, prec_at_k, endpoints['emb'], losses, fids], {images_ph: images_val, pids_ph: pids_val})
-
-                test_summary = None
-                if test_images != None:
-                    images_val, pids_val = sess.run([test_images, test_pids])
-                    test_summary, test_b_prec_at_k, test_b_embs, test_b_loss, test_b_fids = \
-                        sess.run([merged_summary, prec_at_k, endpoints['emb'], losses, test_fids], {images_ph: images_val, pids_ph: pids_val})
-
-                elapsed_time = time.time() - start_time
-
-                # Compute the iteration speed and add it to the summary.
-                # We did observe some weird spikes that we couldn't track down.
-                summary2 = tf.compat.v1.Summary()
-                summary2.value.add(tag='secs_per_iter', simple_value=elapsed_time)
-                summary_writer.add_summary(summary2, step)
-                summary_writer.add_summary(summary, step)
-                if test_summary != None:
-                    test_summary_writer.add_summary(test_summary, step)
-
-                if args.detailed_logs:
-                    log_embs[i], log_loss[i], log_fids[i] = b_embs, b_loss, b_fids
-                    if test_summary:
-                        log_val_embs[i], log_val_loss[i], log_val_fids[i] = test_b_embs, test_b_loss, test_b_fids
-
-                # Do a huge print out of the current progress.
-                seconds_todo = (args.train_iterations - step) * elapsed_time
-                if test_summary:
-                    log.info('iter:{:6d}, loss min|avg|max: {:.3f}|{:.3f}|{:.3f}, '
-                             'batch-p@{}: {:.2%}, val_loss min|avg|max: {:.3f}|{:.3f}|{:.3f}, '
-                             'batch-p@{}: {:.2%}, ETA: {} ({:.2f}s/it)'.format(
-                                 step,
-                                 float(np.min(b_loss)),
-                                 float(np.mean(b_loss)),
-                                 float(np.max(b_loss)),
-                                 args.batch_k - 1, float(b_prec_at_k),
-                                 float(np.min(test_b_loss)),
-                                 float(np.mean(test_b_loss)),
-                                 float(np.max(test_b_loss)),
-                                 args.batch_k - 1, float(test_b_prec_at_k),
-                                 timedelta(seconds=int(seconds_todo)),
-                                 elapsed_time))
-                else:
-                    log.info('iter:{:6d}, loss min|avg|max: {:.3f}|{:.3f}|{:6.3f}, '
-                             'batch-p@{}: {:.2%}, ETA: {} ({:.2f}s/it)'.format(
-                                 step,
-                                 float(np.min(b_loss)),
-                                 float(np.mean(b_loss)),
-                                 float(np.max(b_loss)),
-                                 args.batch_k - 1, float(b_prec_at_k),
-                                 timedelta(seconds=int(seconds_todo)),
-                                 elapsed_time))
-                sys.stdout.flush()
-                sys.stderr.flush()
-
-                # Save a checkpoint of training every so often.
-                if (args.checkpoint_frequency > 0 and
-                        step % args.checkpoint_frequency == 0):
-                    checkpoint_saver.save(sess, os.path.join(
-                        args.experiment_root, 'checkpoint'), global_step=step)
-
-                # Stop the main-loop at the end of the step, if requested.
-                if u.interrupted:
-                    log.info("Interrupted on request!")
-                    break
+        val_elapsed_time = 0.0
+        try:
+            with lb.Uninterrupt(sigs=[SIGINT, SIGTERM], verbose=True) as u:
+                for i in range(start_step, args.train_iterations):
+
+                    # Only fetch the summaries, or the embeddings, losses and FIDs
+                    # for the detailed logs, in the iterations which store them.
+                    if i % args.summary_frequency == 0:
+                        train_step, val_step = get_steps(*step_names, 'summary')
+                    else:
+                        train_step, val_step = get_steps(*step_names)
+
+                    # Compute gradients, update weights, store logs!
+                    start_time = time.time()
+                    _, step, b = train_step()
+                    elapsed_time = time.time() - start_time
+
+                    # The validation forward pass is as expensive as the training
+                    # one, so it is only done every so often. Its time is left out
+                    # of the iteration speed, which would spike otherwise.
+                    test_b = None
+                    if val_step is not None and i % args.val_frequency == 0:
+                        val_start_time = time.time()
+                        test_b = val_step(True)
+                        val_elapsed_time = time.time() - val_start_time
+
+                    # Compute the iteration speed and add it to the summary.
+                    # We did observe some weird spikes that we couldn't track down.
+                    summary2 = tf.compat.v1.Summary()
+                    summary2.value.add(tag='secs_per_iter', simple_value=elapsed_time)
+                    summary_writer.add_summary(summary2, step)
+                    if 'summary' in b:
+                        summary_writer.add_summary(b['summary'], step)
+                    if test_b is not None and 'summary' in test_b:
+                        test_summary_writer.add_summary(test_b['summary'], step)
+
+                    if args.detailed_logs:
+                        if log_errors:
+                            raise RuntimeError('Writing the detailed logs failed.') from log_errors[0]
+                        if test_b is not None:
+                            log_queue.put((i, b['embs'], b['loss'], b['fids'],
+                                           test_b['embs'], test_b['loss'], test_b['fids']))
+                        else:
+                            log_queue.put((i, b['embs'], b['loss'], b['fids']))
+
+                    # Do a huge print out of the current progress.
+                    # The validation time is spread over the iterations in between.
+                    seconds_todo = (args.train_iterations - step) * (
+                        elapsed_time + val_elapsed_time / args.val_frequency)
+                    if test_b is not None:
+                        log.info('iter:{:6d}, loss min|avg|max: {:.3f}|{:.3f}|{:.3f}, '
+                                 'batch-p@{}: {:.2%}, val_loss min|avg|max: {:.3f}|{:.3f}|{:.3f}, '
+                                 'batch-p@{}: {:.2%}, ETA: {} ({:.2f}s/it)'.format(
+                                     step,
+                                     float(b['loss_min']),
+                                     float(b['loss_mean']),
+                                     float(b['loss_max']),
+                                     args.batch_k - 1, float(b['prec_at_k']),
+                                     float(test_b['loss_min']),
+                                     float(test_b['loss_mean']),
+                                     float(test_b['loss_max']),
+                                     args.batch_k - 1, float(test_b['prec_at_k']),
+                                     timedelta(seconds=int(seconds_todo)),
+                                     elapsed_time))
+                    else:
+                        log.info('iter:{:6d}, loss min|avg|max: {:.3f}|{:.3f}|{:6.3f}, '
+                                 'batch-p@{}: {:.2%}, ETA: {} ({:.2f}s/it)'.format(
+                                     step,
+                                     float(b['loss_min']),
+                                     float(b['loss_mean']),
+                                     float(b['loss_max']),
+                                     args.batch_k - 1, float(b['prec_at_k']),
+                                     timedelta(seconds=int(seconds_todo)),
+                                     elapsed_time))
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+
+                    # Save a checkpoint of training every so often.
+                    if (args.checkpoint_frequency > 0 and
+                            step % args.checkpoint_frequency == 0):
+                        checkpoint_saver.save(sess, os.path.join(
+                            args.experiment_root, 'checkpoint'), global_step=step)
+
+                    # Stop the main-loop at the end of the step, if requested.
+                    if u.interrupted:
+                        log.info("Interrupted on request!")
+                        break
+        finally:
+            # Wait for all the detailed logs to be written, even if training
+            # failed, such that the file is closed cleanly and stays readable.
+            if args.detailed_logs:
+                log_queue.put(None)
+                log_writer.join()
+                log_file.close()
+
+        if args.detailed_logs and log_errors:
+            raise RuntimeError('Writing the detailed logs failed.') from log_errors[0]
 
         # Store one final checkpoint. This might be redundant, but it is crucial
         # in case intermediate storing was disabled and it saves a checkpoint